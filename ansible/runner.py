@@ -1,26 +1,237 @@
 import sys
+import os
+import re
 import json
+import time
+import argparse
+import threading
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
-if len(sys.argv) < 3:
-    print("Usage: runner.py <playbook> <json_vars>")
-    sys.exit(1)
+USAGE = (
+    "Usage: runner.py <playbook> <json_vars>\n"
+    "       runner.py --jobs <jobs.ndjson | -> [--workers N] [--output-dir DIR] [--timeout SECONDS]"
+)
 
-playbook = sys.argv[1]
-extra_vars = json.loads(sys.argv[2])
 
-cmd = [
-    "ansible-playbook",
-    playbook,
-    "-i", "inventory.ini",
-    "--extra-vars", json.dumps(extra_vars)
-]
+def build_cmd(playbook, extra_vars, hosts=None):
+    cmd = [
+        "ansible-playbook",
+        playbook,
+        "-i", "inventory.ini",
+        "--extra-vars", json.dumps(extra_vars or {})
+    ]
+    if hosts:
+        if isinstance(hosts, (list, tuple)):
+            hosts = ",".join(hosts)
+        cmd.extend(["--limit", hosts])
+    return cmd
 
-result = subprocess.run(cmd, capture_output=True, text=True)
 
-# Print raw output so backend can parse
-print(result.stdout)
+def run_single(playbook, extra_vars):
+    result = subprocess.run(build_cmd(playbook, extra_vars), capture_output=True, text=True)
 
-# Print stderr for debugging (but does not break parsing)
-if result.stderr.strip():
-    print(result.stderr)
+    # Print raw output so backend can parse
+    print(result.stdout)
+
+    # Print stderr for debugging (but does not break parsing)
+    if result.stderr.strip():
+        print(result.stderr)
+
+
+# ---------------------------------------------------------
+# Batch mode
+# ---------------------------------------------------------
+
+def read_jobs(stream):
+    """
+    Read one JSON job per line:
+      {"id": ..., "playbook": ..., "hosts": ..., "extra_vars": {...}}
+    Only "playbook" is required. Blank lines and '#' comments are ignored.
+
+    Yields (job, error). A line that is not a JSON object yields
+    ({"id": <lineno>}, <message>) so the caller can report it and go on.
+    """
+    for lineno, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            job = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield {"id": lineno}, f"invalid JSON: {e}"
+            continue
+        if not isinstance(job, dict):
+            yield {"id": lineno}, "job must be a JSON object"
+            continue
+        job.setdefault("id", lineno)
+        yield job, None
+
+
+def error_record(job, error, output=None):
+    return {
+        "id": job.get("id"),
+        "playbook": job.get("playbook"),
+        "hosts": job.get("hosts"),
+        "output": output,
+        "status": "error",
+        "returncode": None,
+        "duration": 0.0,
+        "recap": [],
+        "error": error,
+    }
+
+
+def parse_recap(output_path):
+    """Return (failed_or_unreachable, recap_lines) from a saved run output."""
+    recap = []
+    bad = False
+    with open(output_path, "r", errors="replace") as f:
+        for line in f:
+            if "failed=" in line and "unreachable=" in line and ":" in line:
+                line = line.strip()
+                recap.append(line)
+                m_fail = re.search(r"failed=(\d+)", line)
+                m_unreach = re.search(r"unreachable=(\d+)", line)
+                if (m_fail and int(m_fail.group(1))) or (m_unreach and int(m_unreach.group(1))):
+                    bad = True
+    return bad, recap
+
+
+def run_job(job, seq, output_dir, timeout_seconds):
+    """
+    Run one job, streaming stdout+stderr straight into a file under
+    output_dir instead of buffering it in memory. Returns the NDJSON record.
+
+    `seq` is the job's position in the batch; it keeps log file names unique
+    even when job ids repeat.
+    """
+    safe_id = re.sub(r"[^\w.-]", "_", str(job["id"]))
+    output_path = os.path.join(output_dir, f"job-{seq:05d}-{safe_id}.log")
+    record = {
+        "id": job["id"],
+        "playbook": job.get("playbook"),
+        "hosts": job.get("hosts"),
+        "output": output_path,
+    }
+
+    if not job.get("playbook"):
+        return error_record(job, "missing playbook")
+
+    cmd = build_cmd(job["playbook"], job.get("extra_vars"), job.get("hosts"))
+    start = time.monotonic()
+
+    try:
+        with open(output_path, "w") as out:
+            try:
+                proc = subprocess.run(cmd, stdout=out, stderr=subprocess.STDOUT,
+                                      timeout=timeout_seconds)
+                returncode = proc.returncode
+                timed_out = False
+            except subprocess.TimeoutExpired:
+                returncode = None
+                timed_out = True
+    except OSError as e:
+        record = error_record(job, str(e), output_path)
+        record["duration"] = round(time.monotonic() - start, 3)
+        return record
+
+    duration = round(time.monotonic() - start, 3)
+    bad, recap = parse_recap(output_path)
+
+    if timed_out:
+        status = "timeout"
+    elif returncode == 0 and not bad:
+        status = "success"
+    elif recap:
+        status = "failed"
+    else:
+        status = "error"
+
+    record.update(status=status, returncode=returncode, duration=duration, recap=recap)
+    return record
+
+
+def run_batch(stream, workers, output_dir, timeout_seconds):
+    """
+    Run all jobs from `stream` through a bounded pool, printing one NDJSON
+    record per job the moment it finishes. Jobs are read lazily, so a stdin
+    stream starts producing results before it is closed. Returns the number
+    of jobs that did not succeed.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    not_ok = 0
+    write_lock = threading.Lock()
+    slots = threading.BoundedSemaphore(workers)
+
+    def write(record):
+        nonlocal not_ok
+        with write_lock:
+            if record["status"] != "success":
+                not_ok += 1
+            sys.stdout.write(json.dumps(record) + "\n")
+            sys.stdout.flush()
+
+    def finished(job):
+        # Runs in the worker thread as soon as the job is done
+        def callback(future):
+            try:
+                record = future.result()
+            except Exception as e:
+                record = error_record(job, f"{type(e).__name__}: {e}")
+            try:
+                write(record)
+            finally:
+                slots.release()
+        return callback
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for seq, (job, error) in enumerate(read_jobs(stream), start=1):
+            if error:
+                write(error_record(job, error))
+                continue
+            # Don't read further ahead than there are free workers
+            slots.acquire()
+            future = pool.submit(run_job, job, seq, output_dir, timeout_seconds)
+            future.add_done_callback(finished(job))
+
+    return not_ok
+
+
+def main(argv):
+    if any(a == "--jobs" or a.startswith("--jobs=") for a in argv):
+        parser = argparse.ArgumentParser(usage=USAGE)
+        parser.add_argument("--jobs", required=True)
+        parser.add_argument("--workers", type=int, default=4)
+        parser.add_argument("--output-dir", default="runs")
+        parser.add_argument("--timeout", type=int, default=180)
+        args = parser.parse_args(argv)
+
+        workers = max(1, args.workers)
+        try:
+            os.makedirs(args.output_dir, exist_ok=True)
+        except OSError as e:
+            print(f"Cannot create output directory {args.output_dir}: {e}", file=sys.stderr)
+            return 2
+        if args.jobs == "-":
+            not_ok = run_batch(sys.stdin, workers, args.output_dir, args.timeout)
+        else:
+            try:
+                f = open(args.jobs, "r")
+            except OSError as e:
+                print(f"Cannot read jobs file {args.jobs}: {e}", file=sys.stderr)
+                return 2
+            with f:
+                not_ok = run_batch(f, workers, args.output_dir, args.timeout)
+        return 1 if not_ok else 0
+
+    if len(argv) < 2:
+        print(USAGE)
+        return 1
+
+    run_single(argv[0], json.loads(argv[1]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,28 +1,119 @@
 import subprocess
 import os
 import json
+import math
+import re
+import threading
+from contextlib import contextmanager
 from database import get_machines
+from config import (
+    ANSIBLE_FORKS,
+    ANSIBLE_WAVE_TIMEOUT,
+    MAX_CONCURRENT_RUNS,
+    MAX_QUEUED_RUNS,
+    RUN_QUEUE_TIMEOUT,
+)
+from tracing import span, traced
 
 INVENTORY_PATH = "/app/ansible/inventory.ini"
 
 
+# ---------------------------------------------------------
+# Admission control
+# ---------------------------------------------------------
+
+class RunRejected(Exception):
+    """A playbook run was refused before starting."""
+    status_code = 503
+
+
+class MachineBusy(RunRejected):
+    """Another run is already in progress on one of the machines."""
+    status_code = 409
+
+
+class ControllerBusy(RunRejected):
+    """All run slots are taken and the queue is full or timed out."""
+    status_code = 503
+
+
+_run_slots = threading.BoundedSemaphore(max(1, MAX_CONCURRENT_RUNS))
+_state_lock = threading.Lock()
+_busy_machines = set()
+_queued_runs = 0
+
+
+@contextmanager
+def admit(machine_ids, hostnames):
+    """
+    Hold the given machines and one global run slot for the duration of
+    a run.
+
+    Machines are claimed all-or-nothing and never waited on, so a second run
+    on a busy machine fails fast with MachineBusy instead of fighting over
+    the dpkg lock. When every slot is taken, up to MAX_QUEUED_RUNS callers
+    wait at most RUN_QUEUE_TIMEOUT seconds; anyone beyond that gets
+    ControllerBusy straight away.
+    """
+    global _queued_runs
+
+    with _state_lock:
+        busy = [h for mid, h in zip(machine_ids, hostnames) if mid in _busy_machines]
+        if busy:
+            raise MachineBusy(f"A playbook is already running on {', '.join(busy)}.")
+        _busy_machines.update(machine_ids)
+
+    try:
+        if not _run_slots.acquire(blocking=False):
+            with _state_lock:
+                if _queued_runs >= MAX_QUEUED_RUNS:
+                    raise ControllerBusy("Too many playbook runs queued, try again later.")
+                _queued_runs += 1
+
+            print(f"[ANSIBLE] Queued run for {', '.join(hostnames)}")
+            try:
+                acquired = _run_slots.acquire(timeout=RUN_QUEUE_TIMEOUT)
+            finally:
+                with _state_lock:
+                    _queued_runs -= 1
+
+            if not acquired:
+                raise ControllerBusy(
+                    f"No run slot freed up within {RUN_QUEUE_TIMEOUT:g} seconds, try again later."
+                )
+
+        try:
+            yield
+        finally:
+            _run_slots.release()
+    finally:
+        with _state_lock:
+            _busy_machines.difference_update(machine_ids)
+
+
 def ensure_ansible_dir():
     ansible_dir = "/app/ansible"
     if not os.path.isdir(ansible_dir):
         os.makedirs(ansible_dir, exist_ok=True)
 
 
+@traced("ansible.rebuild_inventory")
 def rebuild_inventory():
     ensure_ansible_dir()
 
     machines = get_machines()
 
-    with open(INVENTORY_PATH, "w") as f:
+    # Write then rename so a concurrently starting run never reads a
+    # half-written inventory
+    tmp_path = f"{INVENTORY_PATH}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
         for m in machines:
             id, hostname, ip, username = m
             f.write(f"{hostname} ansible_host={ip} ansible_user={username}\n")
+    os.replace(tmp_path, INVENTORY_PATH)
 
 
+@traced("ansible.run_playbook")
 def run_playbook(playbook, machine_id, extra_vars=None, timeout_seconds=180):
     machines = {m[0]: m for m in get_machines()}
     if machine_id not in machines:
@@ -42,32 +133,121 @@ def run_playbook(playbook, machine_id, extra_vars=None, timeout_seconds=180):
     if extra_vars is not None:
         cmd.extend(["-e", json.dumps(extra_vars)])
 
+    with admit([machine_id], [hostname]):
+        return _execute(cmd, hostname, extra_vars, timeout_seconds)
+
+
+@traced("ansible.run_playbook_multi")
+def run_playbook_multi(playbook, machine_ids, extra_vars=None, timeout_seconds=None, forks=None):
+    """
+    Run one ansible-playbook invocation across several machines at once.
+
+    All hosts receive the same extra_vars. Returns the combined raw output;
+    use split_output_by_host() to get each host's share of it. Raises
+    RunRejected (see admit()) if the run could not be started.
+
+    Hosts are worked through in waves of `forks`, so unless given, the
+    timeout is ANSIBLE_WAVE_TIMEOUT per wave.
+    """
+    machines = {m[0]: m for m in get_machines()}
+    machine_ids = [mid for mid in machine_ids if mid in machines]
+    hostnames = [machines[mid][1] for mid in machine_ids]
+    if not hostnames:
+        return "Machine not found"
+
+    ensure_ansible_dir()
+
+    if forks is None:
+        forks = ANSIBLE_FORKS
+    forks = max(1, min(forks, len(hostnames)))
+
+    if timeout_seconds is None:
+        timeout_seconds = ANSIBLE_WAVE_TIMEOUT * math.ceil(len(hostnames) / forks)
+
+    cmd = [
+        "ansible-playbook",
+        "-i", INVENTORY_PATH,
+        playbook,
+        "--limit", ",".join(hostnames),
+        "--forks", str(forks),
+    ]
+
+    if extra_vars is not None:
+        cmd.extend(["-e", json.dumps(extra_vars)])
+
+    with admit(machine_ids, hostnames):
+        return _execute(cmd, ", ".join(hostnames), extra_vars, timeout_seconds)
+
+
+def _execute(cmd, label, extra_vars, timeout_seconds):
     env = os.environ.copy()
     env["ANSIBLE_HOST_KEY_CHECKING"] = "False"
     env["ANSIBLE_PRIVATE_KEY_FILE"] = "/app/ssh/id_rsa"
 
     # Debug logging into container logs
-    print(f"[ANSIBLE] Running on {hostname}: {' '.join(cmd)}")
+    print(f"[ANSIBLE] Running on {label}: {' '.join(cmd)}")
     if extra_vars:
         print(f"[ANSIBLE] extra_vars = {json.dumps(extra_vars)}")
 
     try:
-        output = subprocess.check_output(
-            cmd,
-            stderr=subprocess.STDOUT,
-            env=env,
-            timeout=timeout_seconds,
-        )
-        print(f"[ANSIBLE] Completed playbook for {hostname}")
-        return output.decode()
+        with span("ansible.subprocess"):
+            output = subprocess.check_output(
+                cmd,
+                stderr=subprocess.STDOUT,
+                env=env,
+                timeout=timeout_seconds,
+            )
+        print(f"[ANSIBLE] Completed playbook for {label}")
+        with span("ansible.decode"):
+            return output.decode()
     except subprocess.TimeoutExpired as e:
         partial = e.output.decode() if e.output else ""
         msg = (
             f"Timed out after {timeout_seconds} seconds while running ansible-playbook.\n\n"
             f"Partial output (if any):\n{partial}"
         )
-        print(f"[ANSIBLE] TIMEOUT for {hostname}")
+        print(f"[ANSIBLE] TIMEOUT for {label}")
         return msg
     except subprocess.CalledProcessError as e:
-        print(f"[ANSIBLE] ERROR for {hostname}")
+        print(f"[ANSIBLE] ERROR for {label}")
         return e.output.decode()
+
+
+# Lines such as "changed: [web1] => (item=nginx)" or "fatal: [web2 -> localhost]: ..."
+_HOST_LINE_RE = re.compile(r"^\s*[a-z_]+: \[([^\]]+?)(?: -> [^\]]+)?\]")
+# Recap lines such as "web1 : ok=4 changed=1 unreachable=0 failed=0 ..."
+_RECAP_LINE_RE = re.compile(r"^(\S+)\s+:\s+ok=\d+")
+_SECTION_PREFIXES = ("PLAY", "TASK", "RUNNING HANDLER")
+
+
+@traced("ansible.split_output_by_host")
+def split_output_by_host(result_text, hostnames):
+    """
+    Split the output of a multi-host run into one text per host.
+
+    Section headers (PLAY / TASK / recap banner) and anything printed before
+    the first host line (e.g. the timeout notice) are kept for every host.
+    Host lines, and the continuation lines that follow them, only go to the
+    host they belong to. Returns a dict hostname -> text.
+    """
+    per_host = {h: [] for h in hostnames}
+    owner = None
+
+    for line in (result_text or "").splitlines():
+        m_host = _HOST_LINE_RE.match(line)
+        m_recap = _RECAP_LINE_RE.match(line)
+
+        if m_host:
+            owner = m_host.group(1).strip()
+        elif m_recap:
+            owner = m_recap.group(1)
+        elif line.startswith(_SECTION_PREFIXES):
+            owner = None
+
+        if owner is None or owner not in per_host:
+            for lines in per_host.values():
+                lines.append(line)
+        else:
+            per_host[owner].append(line)
+
+    return {h: "\n".join(lines) for h, lines in per_host.items()}
@@ -5,6 +5,9 @@ from flask import (
     redirect,
     url_for,
     jsonify,
+    Response,
+    stream_with_context,
+    send_file,
 )
 from database import (
     init_db,
@@ -19,14 +22,33 @@ from database import (
     get_latest_scan_for_machine,
     save_updates,
     get_updates_for_machine,
+    iter_updates,
+    iter_scans,
+    UPDATE_STATUSES,
+    replace_package_versions,
+    has_package_versions,
+    get_package_version_counts,
+    get_hosts_on_versions,
+)
+from debversion import compare_versions, sort_versions
+from run_output import store_run_output, load_run, run_output_path, CHUNK_BYTES
+from tracing import init_tracing, span, traced
+from ansible_interface import (
+    run_playbook,
+    run_playbook_multi,
+    RunRejected,
+    split_output_by_host,
+    rebuild_inventory,
 )
-from ansible_interface import run_playbook, rebuild_inventory
 
 import os
+import io
+import csv
 import json
 import re
 
 app = Flask(__name__)
+init_tracing(app)
 
 # ---------------------------------------------------------
 # Initialize DB
@@ -39,6 +61,7 @@ with app.app_context():
 # Helpers
 # ---------------------------------------------------------
 
+@traced("parse_upgradable")
 def parse_upgradable(upgradable_lines, version_list_results):
     """
     Parse `apt list --upgradable` lines and match them with
@@ -62,7 +85,8 @@ def parse_upgradable(upgradable_lines, version_list_results):
             if len(parts) >= 2:
                 version_choices.append(parts[1].strip())
 
-        versions_map[name] = version_choices
+        # madison lists a version once per archive/arch; show each once, newest first
+        versions_map[name] = sort_versions(version_choices, newest_first=True)
 
     for line in upgradable_lines or []:
         if not line or line.startswith("Listing"):
@@ -96,6 +120,175 @@ def parse_upgradable(upgradable_lines, version_list_results):
     return packages
 
 
+@traced("load_scan_packages")
+def load_scan_packages(latest_row):
+    """
+    Turn a (id, timestamp, data_json) scan row into the package list
+    produced by parse_upgradable. Returns [] for a missing or broken scan.
+    """
+    if not latest_row:
+        return []
+
+    _, _, data_json = latest_row
+    try:
+        with span("json.loads scan"):
+            data = json.loads(data_json)
+    except json.JSONDecodeError:
+        data = {}
+    upgradable_lines = data.get("upgradable", [])
+    version_list_results = data.get("version_list", [])
+    return parse_upgradable(upgradable_lines, version_list_results)
+
+
+def group_by_selection(selections):
+    """
+    Group machines whose Ansible package selections are identical.
+
+    `selections` maps machine_id -> list of {"name", "version"} dicts.
+    Returns a list of (selected_ansible, [machine_id, ...]) tuples, one per
+    distinct selection, in first-seen order.
+    """
+    groups = {}
+    for machine_id, selected in selections.items():
+        key = tuple(sorted((p["name"], p["version"]) for p in selected))
+        if key not in groups:
+            groups[key] = (selected, [])
+        groups[key][1].append(machine_id)
+    return list(groups.values())
+
+
+# Drift report is rebuilt lazily after each scan ingest
+_drift_report_cache = None
+
+
+def parse_installed(installed_lines):
+    """
+    Parse `dpkg-query -W -f='${Package} ${Version}'` lines into a
+    {package: version} dict.
+    """
+    installed = {}
+    for line in installed_lines or []:
+        parts = line.split()
+        if len(parts) >= 2:
+            installed[parts[0]] = parts[1]
+    return installed
+
+
+def refresh_package_versions(machine_id, scan_id, data_json):
+    """
+    Store a freshly ingested scan's versions for the drift report.
+
+    Every installed package is recorded; packages without a pending upgrade
+    get their installed version as candidate. Scans taken before installed
+    versions were collected only contribute their upgradable packages.
+    """
+    global _drift_report_cache
+    try:
+        with span("json.loads scan"):
+            data = json.loads(data_json)
+    except json.JSONDecodeError:
+        data = {}
+
+    upgradable = {
+        p["name"]: p
+        for p in parse_upgradable(data.get("upgradable", []), data.get("version_list", []))
+    }
+    installed = parse_installed(data.get("installed"))
+
+    rows = [
+        (name, version, upgradable[name]["current"] if name in upgradable else version)
+        for name, version in installed.items()
+    ]
+    rows.extend(
+        (name, p.get("from"), p.get("current"))
+        for name, p in upgradable.items()
+        if name not in installed
+    )
+
+    replace_package_versions(machine_id, scan_id, rows)
+    _drift_report_cache = None
+
+
+def backfill_package_versions():
+    """Seed package_versions from each machine's latest scan (older DBs)."""
+    for m in get_machines():
+        latest_row = get_latest_scan_for_machine(m[0])
+        if latest_row:
+            refresh_package_versions(m[0], latest_row[0], latest_row[2])
+
+
+@traced("build_drift_report")
+def build_drift_report(lagging_hosts=10):
+    """
+    Summarize version drift per package across the fleet.
+
+    Works from the host counts per (package, installed, candidate) that
+    are maintained at scan ingest, so neither the scans nor the per-host
+    rows are aggregated here and only distinct versions are compared.
+    Returns a list of dicts, packages with the most hosts behind first.
+    """
+    report = {}
+    for package, installed, candidate, count in get_package_version_counts():
+        entry = report.setdefault(package, {
+            "name": package,
+            "hosts": 0,
+            "installed": {},
+            "candidate": {},
+        })
+        entry["hosts"] += count
+        if installed:
+            entry["installed"][installed] = entry["installed"].get(installed, 0) + count
+        if candidate:
+            entry["candidate"][candidate] = entry["candidate"].get(candidate, 0) + count
+
+    oldest_pairs = []
+    for entry in report.values():
+        known = sort_versions(list(entry["installed"]) + list(entry["candidate"]))
+        newest = known[-1] if known else None
+        position = {v: i for i, v in enumerate(known)}
+
+        installed_sorted = sort_versions(entry["installed"])
+        entry["newest"] = newest
+        entry["installed_versions"] = [
+            {
+                "version": v,
+                "hosts": entry["installed"][v],
+                "behind_by": len(known) - 1 - position[v],
+            }
+            for v in installed_sorted
+        ]
+        entry["candidate_versions"] = [
+            {"version": v, "hosts": entry["candidate"][v]}
+            for v in sort_versions(entry["candidate"], newest_first=True)
+        ]
+        entry["hosts_behind"] = sum(
+            n for v, n in entry["installed"].items()
+            if newest and compare_versions(v, newest) < 0
+        )
+        entry["oldest"] = installed_sorted[0] if installed_sorted else None
+        if entry["oldest"]:
+            oldest_pairs.append((entry["name"], entry["oldest"]))
+
+    hosts_by_pair = get_hosts_on_versions(oldest_pairs, limit_per_pair=lagging_hosts)
+    for entry in report.values():
+        entry["lagging"] = hosts_by_pair.get((entry["name"], entry["oldest"]), [])
+
+    return sorted(report.values(), key=lambda e: (-e["hosts_behind"], e["name"]))
+
+
+def get_drift_report():
+    global _drift_report_cache
+    if _drift_report_cache is None:
+        _drift_report_cache = build_drift_report()
+    return _drift_report_cache
+
+
+with app.app_context():
+    if not has_package_versions():
+        backfill_package_versions()
+
+
+@traced("parse_ansible_summary")
 def parse_ansible_summary(result_text: str):
     """
     Parse Ansible play recap from raw output and classify status.
@@ -143,6 +336,61 @@ def parse_ansible_summary(result_text: str):
     return {"status": status, "recap": recap_line}
 
 
+# ---------------------------------------------------------
+# Export helpers
+# ---------------------------------------------------------
+
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+
+UPDATE_EXPORT_FIELDS = ["id", "machine_id", "hostname", "timestamp", "package", "version", "status"]
+SCAN_EXPORT_FIELDS = ["scan_id", "machine_id", "hostname", "timestamp", "package", "current", "from"]
+
+
+def iter_scan_package_rows(scan_rows):
+    """Flatten scan rows into one row per upgradable package."""
+    for scan_id, machine_id, hostname, timestamp, data_json in scan_rows:
+        for pkg in load_scan_packages((scan_id, timestamp, data_json)):
+            yield (scan_id, machine_id, hostname, timestamp, pkg["name"], pkg["current"], pkg["from"])
+
+
+def encode_export(rows, fields, fmt, chunk_rows=500):
+    """
+    Encode rows as CSV or NDJSON, yielding one string chunk per
+    `chunk_rows` rows so the response can be streamed.
+    """
+    buf = io.StringIO()
+    writer = csv.writer(buf) if fmt == "csv" else None
+    if writer:
+        writer.writerow(fields)
+
+    pending = 0
+    for row in rows:
+        if writer:
+            writer.writerow(row)
+        else:
+            buf.write(json.dumps(dict(zip(fields, row))) + "\n")
+        pending += 1
+        if pending >= chunk_rows:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+            pending = 0
+
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def export_response(rows, fields, fmt, filename):
+    return Response(
+        stream_with_context(encode_export(rows, fields, fmt)),
+        mimetype=EXPORT_FORMATS[fmt],
+        headers={"Content-Disposition": f"attachment; filename={filename}.{fmt}"},
+    )
+
+
 # ---------------------------------------------------------
 # Routes
 # ---------------------------------------------------------
@@ -174,7 +422,9 @@ def machines_add():
 
 @app.route("/machines/delete/<int:id>")
 def machines_delete(id):
+    global _drift_report_cache
     delete_machine(id)
+    _drift_report_cache = None
     rebuild_inventory()
     return redirect(url_for("machines_page"))
 
@@ -189,18 +439,8 @@ def machine_detail(machine_id):
     latest_row = get_latest_scan_for_machine(machine_id)
     updates = get_updates_for_machine(machine_id)
 
-    packages = []
-    latest_timestamp = None
-
-    if latest_row:
-        _, latest_timestamp, data_json = latest_row
-        try:
-            data = json.loads(data_json)
-        except json.JSONDecodeError:
-            data = {}
-        upgradable_lines = data.get("upgradable", [])
-        version_list_results = data.get("version_list", [])
-        packages = parse_upgradable(upgradable_lines, version_list_results)
+    latest_timestamp = latest_row[1] if latest_row else None
+    packages = load_scan_packages(latest_row)
 
     return render_template(
         "machine.html",
@@ -222,17 +462,24 @@ def scan(machine_id):
 
     rebuild_inventory()
 
-    result_text = run_playbook("ansible/playbook_scan.yml", machine_id)
+    try:
+        result_text = run_playbook("ansible/playbook_scan.yml", machine_id)
+    except RunRejected as e:
+        return str(e), e.status_code
 
     json_path = f"/app/ansible/scans/{hostname}.json"
 
     if os.path.exists(json_path):
         with open(json_path, "r") as f:
             data_json = f.read()
-        save_scan(machine_id_val, data_json)
+        scan_id = save_scan(machine_id_val, data_json)
+        refresh_package_versions(machine_id_val, scan_id, data_json)
         return redirect(url_for("machine_detail", machine_id=machine_id_val))
     else:
-        return f"<pre>{result_text}</pre>"
+        run_id = store_run_output(machine_id_val, "ansible/playbook_scan.yml", result_text)
+        if run_id is None:
+            return f"<pre>{result_text}</pre>"
+        return redirect(url_for("run_view", run_id=run_id))
 
 
 @app.route("/update/<int:machine_id>", methods=["GET", "POST"])
@@ -245,16 +492,7 @@ def update(machine_id):
 
     # Load latest scan to know upgradable packages
     latest_row = get_latest_scan_for_machine(machine_id_val)
-    packages = []
-    if latest_row:
-        _, _, data_json = latest_row
-        try:
-            data = json.loads(data_json)
-        except json.JSONDecodeError:
-            data = {}
-        upgradable_lines = data.get("upgradable", [])
-        version_list_results = data.get("version_list", [])
-        packages = parse_upgradable(upgradable_lines, version_list_results)
+    packages = load_scan_packages(latest_row)
 
     if request.method == "GET":
         # Show UI with checkboxes + version dropdowns
@@ -317,26 +555,127 @@ def update(machine_id):
 
     extra_vars = {"packages": selected_ansible}
     print(f"[UPDATE] Machine {machine_id_val} ({hostname}) selected packages: {selected_ansible}")
-    result = run_playbook(
-        "ansible/playbook_update.yml",
-        machine_id_val,
-        extra_vars=extra_vars,
-    )
+    try:
+        result = run_playbook(
+            "ansible/playbook_update.yml",
+            machine_id_val,
+            extra_vars=extra_vars,
+        )
+    except RunRejected as e:
+        return str(e), e.status_code
 
     summary = parse_ansible_summary(result)
+    run_id = store_run_output(machine_id_val, "ansible/playbook_update.yml", result)
 
     # Log the update run (one row per package) using the "display" versions
-    save_updates(machine_id_val, selected_db, result)
+    save_updates(machine_id_val, selected_db, result, run_id=run_id)
 
     return render_template(
         "update_result.html",
         machine=machine,
         selected=selected_db,
+        run=load_run(run_id),
         result=result,
+        chunk_bytes=CHUNK_BYTES,
         summary=summary,
     )
 
 
+@app.route("/update/fleet", methods=["GET", "POST"])
+def update_fleet():
+    """
+    Update several machines at once. Machines whose package selections
+    come out identical share a single ansible-playbook run (with forks);
+    the combined output is split back per host before logging.
+    """
+    machines = get_machines()
+    packages_by_machine = {
+        m[0]: load_scan_packages(get_latest_scan_for_machine(m[0]))
+        for m in machines
+    }
+
+    if request.method == "GET":
+        return render_template(
+            "update_fleet.html",
+            machines=machines,
+            packages_by_machine=packages_by_machine,
+        )
+
+    # Optional package filter: only these names (if upgradable) are updated
+    wanted = set((request.form.get("packages") or "").split())
+
+    selections = {}
+    selections_db = {}
+    for m in machines:
+        if f"machine_{m[0]}" not in request.form:
+            continue
+
+        selected_ansible = []
+        selected_db = []
+        for pkg in packages_by_machine[m[0]]:
+            if wanted and pkg["name"] not in wanted:
+                continue
+            selected_ansible.append({"name": pkg["name"], "version": "latest"})
+            selected_db.append({
+                "name": pkg["name"],
+                "version": pkg.get("current") or "latest",
+            })
+
+        if selected_ansible:
+            selections[m[0]] = selected_ansible
+            selections_db[m[0]] = selected_db
+
+    if not selections:
+        return "No machines with matching upgradable packages selected.", 400
+
+    rebuild_inventory()
+
+    machines_by_id = {m[0]: m for m in machines}
+    results = []
+
+    for selected_ansible, machine_ids in group_by_selection(selections):
+        hostnames = [machines_by_id[mid][1] for mid in machine_ids]
+        print(f"[UPDATE] Group {hostnames} selected packages: {selected_ansible}")
+
+        try:
+            result = run_playbook_multi(
+                "ansible/playbook_update.yml",
+                machine_ids,
+                extra_vars={"packages": selected_ansible},
+            )
+        except RunRejected as e:
+            # Skip this group but still run the others
+            results.append({
+                "packages": selected_ansible,
+                "hosts": [
+                    {
+                        "machine": machines_by_id[mid],
+                        "summary": {"status": "rejected", "recap": None, "reason": str(e)},
+                        "run_id": None,
+                    }
+                    for mid in machine_ids
+                ],
+            })
+            continue
+
+        per_host = split_output_by_host(result, hostnames)
+
+        hosts = []
+        for mid, hostname in zip(machine_ids, hostnames):
+            host_result = per_host[hostname]
+            run_id = store_run_output(mid, "ansible/playbook_update.yml", host_result)
+            save_updates(mid, selections_db[mid], host_result, run_id=run_id)
+            hosts.append({
+                "machine": machines_by_id[mid],
+                "summary": parse_ansible_summary(host_result),
+                "run_id": run_id,
+            })
+
+        results.append({"packages": selected_ansible, "hosts": hosts})
+
+    return render_template("update_fleet_result.html", groups=results)
+
+
 @app.route("/downgrade/<int:machine_id>/<package>", methods=["GET", "POST"])
 def downgrade_package(machine_id, package):
     """
@@ -353,15 +692,7 @@ def downgrade_package(machine_id, package):
     if not latest_row:
         return "No scan data available for this machine.", 400
 
-    _, _, data_json = latest_row
-    try:
-        data = json.loads(data_json)
-    except json.JSONDecodeError:
-        data = {}
-
-    upgradable_lines = data.get("upgradable", [])
-    version_list_results = data.get("version_list", [])
-    packages = parse_upgradable(upgradable_lines, version_list_results)
+    packages = load_scan_packages(latest_row)
 
     pkg_info = next((p for p in packages if p["name"] == package), None)
     if not pkg_info:
@@ -392,24 +723,106 @@ def downgrade_package(machine_id, package):
     rebuild_inventory()
 
     extra_vars = {"packages": selected_ansible}
-    result = run_playbook(
-        "ansible/playbook_update.yml",
-        machine_id_val,
-        extra_vars=extra_vars,
-    )
+    try:
+        result = run_playbook(
+            "ansible/playbook_update.yml",
+            machine_id_val,
+            extra_vars=extra_vars,
+        )
+    except RunRejected as e:
+        return str(e), e.status_code
 
     summary = parse_ansible_summary(result)
-    save_updates(machine_id_val, selected_db, result)
+    run_id = store_run_output(machine_id_val, "ansible/playbook_update.yml", result)
+    save_updates(machine_id_val, selected_db, result, run_id=run_id)
 
     return render_template(
         "update_result.html",
         machine=machine,
         selected=selected_db,
+        run=load_run(run_id),
         result=result,
+        chunk_bytes=CHUNK_BYTES,
         summary=summary,
     )
 
 
+@app.route("/runs/<int:run_id>")
+def run_view(run_id):
+    run = load_run(run_id)
+    if not run:
+        return "Run not found", 404
+
+    machine = get_machine(run["machine_id"])
+    return render_template(
+        "run_output.html",
+        run=run,
+        machine=machine,
+        chunk_bytes=CHUNK_BYTES,
+    )
+
+
+@app.route("/runs/<int:run_id>/raw")
+def run_raw(run_id):
+    """
+    Raw run output. Honors HTTP Range requests so the viewer can fetch
+    it a chunk at a time.
+    """
+    path = run_output_path(run_id)
+    if not load_run(run_id) or not os.path.exists(path):
+        return "Run not found", 404
+
+    return send_file(path, mimetype="text/plain", conditional=True)
+
+
+@app.route("/drift")
+def drift_report():
+    packages = get_drift_report()
+    return render_template("drift.html", packages=packages)
+
+
+@app.route("/export/updates.<fmt>")
+def export_updates(fmt):
+    """
+    Stream every update row across the fleet as CSV or NDJSON.
+    Query params: since (inclusive), until (exclusive), status (comma list).
+    """
+    if fmt not in EXPORT_FORMATS:
+        return f"Unsupported export format '{fmt}'.", 400
+
+    known = {s.lower(): s for s in UPDATE_STATUSES}
+    statuses = []
+    for value in (request.args.get("status") or "").split(","):
+        value = value.strip().lower()
+        if not value:
+            continue
+        if value not in known:
+            return f"Unknown status '{value}'. Expected one of: {', '.join(UPDATE_STATUSES)}.", 400
+        statuses.append(known[value])
+    rows = iter_updates(
+        since=request.args.get("since"),
+        until=request.args.get("until"),
+        statuses=statuses or None,
+    )
+    return export_response(rows, UPDATE_EXPORT_FIELDS, fmt, "updates")
+
+
+@app.route("/export/scans.<fmt>")
+def export_scans(fmt):
+    """
+    Stream one row per upgradable package per scan across the fleet.
+    Query params: since (inclusive), until (exclusive).
+    """
+    if fmt not in EXPORT_FORMATS:
+        return f"Unsupported export format '{fmt}'.", 400
+
+    scan_rows = iter_scans(
+        since=request.args.get("since"),
+        until=request.args.get("until"),
+    )
+    return export_response(iter_scan_package_rows(scan_rows), SCAN_EXPORT_FIELDS, fmt, "scan_packages")
+
+
 @app.route("/generate_enrollment_script")
 def generate_enrollment_script():
     ssh_key_path = "/app/ssh/id_rsa.pub"
@@ -1 +1,28 @@
+import os
+
 DB_PATH = "/app/db.sqlite"
+
+# Upper bound on parallel hosts for a single multi-host ansible-playbook run
+ANSIBLE_FORKS = int(os.environ.get("ANSIBLE_FORKS", "20"))
+
+# Timeout for each wave of ANSIBLE_FORKS hosts; a multi-host run gets this
+# times the number of waves it needs
+ANSIBLE_WAVE_TIMEOUT = int(os.environ.get("ANSIBLE_WAVE_TIMEOUT", "180"))
+
+# Opt-in request tracing (see tracing.py)
+TRACE_ENABLED = os.environ.get("TRACE_ENABLED", "0") == "1"
+TRACE_SLOW_MS = float(os.environ.get("TRACE_SLOW_MS", "1000"))
+TRACE_SLOW_LOG = os.environ.get("TRACE_SLOW_LOG", "/app/slow_requests.log")
+TRACE_MAX_SPANS = int(os.environ.get("TRACE_MAX_SPANS", "200"))
+
+# On-demand cProfile dumps for a single request (?_profile=1)
+TRACE_PROFILE_ENABLED = os.environ.get("TRACE_PROFILE_ENABLED", "0") == "1"
+TRACE_PROFILE_DIR = os.environ.get("TRACE_PROFILE_DIR", "/app/profiles")
+
+# Raw ansible-playbook output, one file per run (served by byte range)
+RUN_OUTPUT_DIR = os.environ.get("RUN_OUTPUT_DIR", "/app/runs")
+
+# Admission control for ansible-playbook runs (per controller process)
+MAX_CONCURRENT_RUNS = int(os.environ.get("MAX_CONCURRENT_RUNS", "4"))
+MAX_QUEUED_RUNS = int(os.environ.get("MAX_QUEUED_RUNS", "16"))
+RUN_QUEUE_TIMEOUT = float(os.environ.get("RUN_QUEUE_TIMEOUT", "30"))
@@ -2,6 +2,8 @@ import sqlite3
 import os
 import datetime
 
+from tracing import span, traced
+
 DB_PATH = os.path.join(os.path.dirname(__file__), "centralized_update.db")
 
 
@@ -9,6 +11,7 @@ def get_conn():
     return sqlite3.connect(DB_PATH)
 
 
+@traced("db.init_db")
 def init_db():
     conn = get_conn()
     c = conn.cursor()
@@ -52,6 +55,68 @@ def init_db():
         """
     )
 
+    # Latest installed/candidate version per machine and package, refreshed
+    # on every scan ingest so the drift report never has to re-parse scans
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS package_versions (
+            machine_id INTEGER,
+            scan_id INTEGER,
+            package TEXT,
+            installed TEXT,
+            candidate TEXT,
+            PRIMARY KEY (machine_id, package)
+        )
+        """
+    )
+    # Lets the drift report's "furthest behind" lookup stop after LIMIT rows
+    c.execute("DROP INDEX IF EXISTS idx_package_versions_package")
+    c.execute(
+        "CREATE INDEX IF NOT EXISTS idx_package_versions_lookup "
+        "ON package_versions (package, installed, machine_id)"
+    )
+
+    # Host counts per (package, installed, candidate), kept in step with
+    # package_versions on every ingest so the drift report never has to
+    # aggregate the whole table. NULL versions are stored as ''.
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS package_version_counts (
+            package TEXT NOT NULL,
+            installed TEXT NOT NULL,
+            candidate TEXT NOT NULL,
+            hosts INTEGER NOT NULL,
+            PRIMARY KEY (package, installed, candidate)
+        )
+        """
+    )
+    c.execute("SELECT 1 FROM package_version_counts LIMIT 1")
+    if c.fetchone() is None:
+        c.execute(
+            """
+            INSERT INTO package_version_counts (package, installed, candidate, hosts)
+            SELECT package, COALESCE(installed, ''), COALESCE(candidate, ''), COUNT(*)
+            FROM package_versions
+            GROUP BY 1, 2, 3
+            """
+        )
+
+    # Ansible runs: raw output lives in a file, this holds its metadata and
+    # the index of failed lines built when the output was saved
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            machine_id INTEGER,
+            timestamp TEXT,
+            playbook TEXT,
+            size INTEGER,
+            line_count INTEGER,
+            failures TEXT
+        )
+        """
+    )
+
     # Ensure new columns exist on older DBs
     c.execute("PRAGMA table_info(updates)")
     cols = [row[1] for row in c.fetchall()]
@@ -68,6 +133,16 @@ def init_db():
         except sqlite3.OperationalError:
             pass
 
+    if "run_id" not in cols:
+        try:
+            c.execute("ALTER TABLE updates ADD COLUMN run_id INTEGER")
+        except sqlite3.OperationalError:
+            pass
+
+    # Date-range lookups used by the fleet-wide exports
+    c.execute("CREATE INDEX IF NOT EXISTS idx_updates_timestamp ON updates (timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_scans_timestamp ON scans (timestamp)")
+
     conn.commit()
     conn.close()
 
@@ -76,6 +151,7 @@ def init_db():
 # Machines
 # ----------------------------------------------------
 
+@traced("db.get_machines")
 def get_machines():
     conn = get_conn()
     c = conn.cursor()
@@ -85,6 +161,7 @@ def get_machines():
     return rows
 
 
+@traced("db.add_machine")
 def add_machine(hostname, ip, username):
     conn = get_conn()
     c = conn.cursor()
@@ -96,14 +173,18 @@ def add_machine(hostname, ip, username):
     conn.close()
 
 
+@traced("db.delete_machine")
 def delete_machine(machine_id):
     conn = get_conn()
     c = conn.cursor()
     c.execute("DELETE FROM machines WHERE id = ?", (machine_id,))
+    _adjust_version_counts(c, machine_id, -1)
+    c.execute("DELETE FROM package_versions WHERE machine_id = ?", (machine_id,))
     conn.commit()
     conn.close()
 
 
+@traced("db.get_machine")
 def get_machine(machine_id):
     conn = get_conn()
     c = conn.cursor()
@@ -116,6 +197,7 @@ def get_machine(machine_id):
     return row
 
 
+@traced("db.get_machine_by_hostname")
 def get_machine_by_hostname(hostname):
     conn = get_conn()
     c = conn.cursor()
@@ -128,6 +210,7 @@ def get_machine_by_hostname(hostname):
     return row
 
 
+@traced("db.update_machine_ip")
 def update_machine_ip(hostname, ip):
     conn = get_conn()
     c = conn.cursor()
@@ -143,6 +226,7 @@ def update_machine_ip(hostname, ip):
 # Scans
 # ----------------------------------------------------
 
+@traced("db.save_scan")
 def save_scan(machine_id, data_json):
     conn = get_conn()
     c = conn.cursor()
@@ -151,10 +235,13 @@ def save_scan(machine_id, data_json):
         "INSERT INTO scans (machine_id, timestamp, data) VALUES (?, ?, ?)",
         (machine_id, ts, data_json),
     )
+    scan_id = c.lastrowid
     conn.commit()
     conn.close()
+    return scan_id
 
 
+@traced("db.get_scans_for_machine")
 def get_scans_for_machine(machine_id):
     conn = get_conn()
     c = conn.cursor()
@@ -167,6 +254,7 @@ def get_scans_for_machine(machine_id):
     return rows
 
 
+@traced("db.get_latest_scan_for_machine")
 def get_latest_scan_for_machine(machine_id):
     conn = get_conn()
     c = conn.cursor()
@@ -179,10 +267,163 @@ def get_latest_scan_for_machine(machine_id):
     return row
 
 
+# ----------------------------------------------------
+# Package versions (drift report)
+# ----------------------------------------------------
+
+@traced("db.replace_package_versions")
+def replace_package_versions(machine_id, scan_id, rows):
+    """
+    Replace a machine's stored versions with those from its newest scan.
+    `rows` are (package, installed, candidate) tuples.
+    """
+    conn = get_conn()
+    c = conn.cursor()
+    _adjust_version_counts(c, machine_id, -1)
+    c.execute("DELETE FROM package_versions WHERE machine_id = ?", (machine_id,))
+    c.executemany(
+        """
+        INSERT OR REPLACE INTO package_versions (machine_id, scan_id, package, installed, candidate)
+        VALUES (?, ?, ?, ?, ?)
+        """,
+        [(machine_id, scan_id, package, installed, candidate) for package, installed, candidate in rows],
+    )
+    _adjust_version_counts(c, machine_id, 1)
+    conn.commit()
+    conn.close()
+
+
+def _adjust_version_counts(c, machine_id, delta):
+    """
+    Add `delta` to the package_version_counts rows matching a machine's
+    current package_versions rows, dropping rows that reach zero. Runs on
+    the caller's cursor so it shares the caller's transaction.
+    """
+    c.execute(
+        """
+        INSERT INTO package_version_counts (package, installed, candidate, hosts)
+        SELECT package, COALESCE(installed, ''), COALESCE(candidate, ''), ?
+        FROM package_versions
+        WHERE machine_id = ?
+        ON CONFLICT (package, installed, candidate)
+        DO UPDATE SET hosts = hosts + excluded.hosts
+        """,
+        (delta, machine_id),
+    )
+    c.execute("DELETE FROM package_version_counts WHERE hosts <= 0")
+
+
+@traced("db.has_package_versions")
+def has_package_versions():
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("SELECT 1 FROM package_versions LIMIT 1")
+    row = c.fetchone()
+    conn.close()
+    return row is not None
+
+
+@traced("db.get_package_version_counts")
+def get_package_version_counts():
+    """
+    Per package, how many hosts sit on each (installed, candidate) pair:
+      (package, installed, candidate, host_count)
+
+    Only packages with a pending upgrade on at least one host are included;
+    for those, every host that has the package installed is counted.
+    """
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute(
+        """
+        SELECT package, NULLIF(installed, ''), NULLIF(candidate, ''), hosts
+        FROM package_version_counts
+        WHERE package IN (
+            SELECT package
+            FROM package_version_counts
+            WHERE candidate != installed
+        )
+        ORDER BY package
+        """
+    )
+    rows = c.fetchall()
+    conn.close()
+    return rows
+
+
+@traced("db.get_hosts_on_versions")
+def get_hosts_on_versions(pairs, limit_per_pair=10):
+    """
+    Hosts currently on the given (package, installed) pairs:
+      {(package, installed): [(machine_id, hostname), ...]}
+    """
+    result = {}
+    conn = get_conn()
+    c = conn.cursor()
+    for package, installed in pairs:
+        c.execute(
+            """
+            SELECT pv.machine_id, m.hostname
+            FROM package_versions pv
+            LEFT JOIN machines m ON m.id = pv.machine_id
+            WHERE pv.package = ? AND pv.installed IS ?
+            ORDER BY pv.machine_id
+            LIMIT ?
+            """,
+            (package, installed, limit_per_pair),
+        )
+        result[(package, installed)] = c.fetchall()
+    conn.close()
+    return result
+
+
+# ----------------------------------------------------
+# Runs
+# ----------------------------------------------------
+
+@traced("db.save_run")
+def save_run(machine_id, playbook, size, line_count, failures_json):
+    conn = get_conn()
+    c = conn.cursor()
+    ts = datetime.datetime.utcnow().isoformat()
+    c.execute(
+        """
+        INSERT INTO runs (machine_id, timestamp, playbook, size, line_count, failures)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """,
+        (machine_id, ts, playbook, size, line_count, failures_json),
+    )
+    run_id = c.lastrowid
+    conn.commit()
+    conn.close()
+    return run_id
+
+
+@traced("db.get_run")
+def get_run(run_id):
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute(
+        """
+        SELECT id, machine_id, timestamp, playbook, size, line_count, failures
+        FROM runs
+        WHERE id = ?
+        """,
+        (run_id,),
+    )
+    row = c.fetchone()
+    conn.close()
+    return row
+
+
 # ----------------------------------------------------
 # Updates
 # ----------------------------------------------------
 
+# Values _classify_status() stores in updates.status
+UPDATE_STATUSES = ("Success", "Failed", "Skipped", "Unknown")
+
+
 def _classify_status(result_text, pkg_name):
     """
     Very simple per-package status classifier based on Ansible output.
@@ -215,12 +456,15 @@ def _classify_status(result_text, pkg_name):
     return "Unknown"
 
 
-def save_updates(machine_id, packages, result_text):
+@traced("db.save_updates")
+def save_updates(machine_id, packages, result_text, run_id=None):
     """
     `packages` is a list of dicts:
       { "name": <pkg_name>, "version": <display_version> }
 
-    We insert one row per package with a per-package status.
+    We insert one row per package with a per-package status. When the
+    output was stored as a run, rows point at it via run_id instead of
+    each carrying their own copy of the output.
     """
     conn = get_conn()
     c = conn.cursor()
@@ -233,22 +477,23 @@ def save_updates(machine_id, packages, result_text):
 
         c.execute(
             """
-            INSERT INTO updates (machine_id, timestamp, package, version, status, result)
-            VALUES (?, ?, ?, ?, ?, ?)
+            INSERT INTO updates (machine_id, timestamp, package, version, status, result, run_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
             """,
-            (machine_id, ts, name, version, status, result_text),
+            (machine_id, ts, name, version, status, None if run_id else result_text, run_id),
         )
 
     conn.commit()
     conn.close()
 
 
+@traced("db.get_updates_for_machine")
 def get_updates_for_machine(machine_id):
     conn = get_conn()
     c = conn.cursor()
     c.execute(
         """
-        SELECT id, timestamp, package, version, status
+        SELECT id, timestamp, package, version, status, run_id
         FROM updates
         WHERE machine_id = ?
         ORDER BY id DESC
@@ -258,3 +503,83 @@ def get_updates_for_machine(machine_id):
     rows = c.fetchall()
     conn.close()
     return rows
+
+
+# ----------------------------------------------------
+# Fleet-wide exports
+# ----------------------------------------------------
+
+def _date_filters(column, since, until):
+    clauses = []
+    params = []
+    if since:
+        clauses.append(f"{column} >= ?")
+        params.append(since)
+    if until:
+        clauses.append(f"{column} < ?")
+        params.append(until)
+    return clauses, params
+
+
+def _iter_rows(name, query, params, batch_size):
+    """
+    Yield rows from `query` a batch at a time so the full result set is
+    never held in memory. The connection stays open until the generator
+    is exhausted or closed. The query and each fetched batch are traced
+    as `name`.
+    """
+    conn = get_conn()
+    try:
+        c = conn.cursor()
+        with span(name):
+            c.execute(query, params)
+        while True:
+            with span(name):
+                rows = c.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        conn.close()
+
+
+def iter_updates(since=None, until=None, statuses=None, batch_size=1000):
+    """
+    Iterate update rows across all machines, oldest first:
+      (id, machine_id, hostname, timestamp, package, version, status)
+
+    `since` is inclusive and `until` exclusive (ISO timestamps or dates).
+    `statuses` optionally restricts to a list of status values.
+    """
+    clauses, params = _date_filters("u.timestamp", since, until)
+    if statuses:
+        clauses.append(f"u.status IN ({', '.join('?' for _ in statuses)})")
+        params.extend(statuses)
+
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    query = f"""
+        SELECT u.id, u.machine_id, m.hostname, u.timestamp, u.package, u.version, u.status
+        FROM updates u
+        LEFT JOIN machines m ON m.id = u.machine_id
+        {where}
+        ORDER BY u.id
+    """
+    return _iter_rows("db.iter_updates", query, params, batch_size)
+
+
+def iter_scans(since=None, until=None, batch_size=100):
+    """
+    Iterate scan rows across all machines, oldest first:
+      (id, machine_id, hostname, timestamp, data)
+    """
+    clauses, params = _date_filters("s.timestamp", since, until)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    query = f"""
+        SELECT s.id, s.machine_id, m.hostname, s.timestamp, s.data
+        FROM scans s
+        LEFT JOIN machines m ON m.id = s.machine_id
+        {where}
+        ORDER BY s.id
+    """
+    return _iter_rows("db.iter_scans", query, params, batch_size)
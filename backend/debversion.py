@@ -0,0 +1,106 @@
+"""
+Debian package version comparison.
+
+Implements the dpkg ordering rules: [epoch:]upstream[-revision], where
+digits compare numerically, letters sort before non-letters and '~' sorts
+before everything (even the end of the string), so 1.0~rc1 < 1.0.
+
+Comparisons are memoized since the same few versions get compared over and
+over when sorting a fleet's worth of packages.
+"""
+from functools import cmp_to_key, lru_cache
+
+_DIGITS = "0123456789"
+
+
+def parse_version(version):
+    """Split a version string into (epoch, upstream, revision)."""
+    version = (version or "").strip()
+
+    epoch = 0
+    if ":" in version:
+        epoch_str, version = version.split(":", 1)
+        try:
+            epoch = int(epoch_str)
+        except ValueError:
+            epoch = 0
+
+    revision = ""
+    if "-" in version:
+        version, revision = version.rsplit("-", 1)
+
+    return epoch, version, revision
+
+
+def _order(c):
+    if c == "~":
+        return -1
+    if c in _DIGITS:
+        return 0
+    if c.isascii() and c.isalpha():
+        return ord(c)
+    return ord(c) + 256
+
+
+def _compare_part(a, b):
+    """dpkg's verrevcmp() for an upstream or revision string."""
+    i = j = 0
+    len_a, len_b = len(a), len(b)
+
+    while i < len_a or j < len_b:
+        # Non-digit prefix, character by character
+        while (i < len_a and a[i] not in _DIGITS) or (j < len_b and b[j] not in _DIGITS):
+            ac = _order(a[i]) if i < len_a else 0
+            bc = _order(b[j]) if j < len_b else 0
+            if ac != bc:
+                return ac - bc
+            i += 1
+            j += 1
+
+        # Digit run, compared numerically
+        while i < len_a and a[i] == "0":
+            i += 1
+        while j < len_b and b[j] == "0":
+            j += 1
+
+        first_diff = 0
+        while i < len_a and a[i] in _DIGITS and j < len_b and b[j] in _DIGITS:
+            if not first_diff:
+                first_diff = ord(a[i]) - ord(b[j])
+            i += 1
+            j += 1
+
+        if i < len_a and a[i] in _DIGITS:
+            return 1
+        if j < len_b and b[j] in _DIGITS:
+            return -1
+        if first_diff:
+            return first_diff
+
+    return 0
+
+
+@lru_cache(maxsize=65536)
+def compare_versions(a, b):
+    """Return -1, 0 or 1 as version `a` is older, equal or newer than `b`."""
+    if a == b:
+        return 0
+
+    epoch_a, upstream_a, revision_a = parse_version(a)
+    epoch_b, upstream_b, revision_b = parse_version(b)
+
+    result = epoch_a - epoch_b
+    if not result:
+        result = _compare_part(upstream_a, upstream_b)
+    if not result:
+        result = _compare_part(revision_a, revision_b)
+
+    return (result > 0) - (result < 0)
+
+
+version_key = cmp_to_key(compare_versions)
+
+
+def sort_versions(versions, newest_first=False):
+    """Return the distinct versions in Debian order."""
+    return sorted(set(versions), key=version_key, reverse=newest_first)
@@ -0,0 +1,111 @@
+"""
+Storage for raw ansible-playbook output.
+
+Each run is written once to RUN_OUTPUT_DIR/<run_id>.log and served back by
+byte range, so pages never embed multi-megabyte output. While saving, an
+index of failed lines (with their byte offsets and the task they belong to)
+is built so the viewer can jump straight to them.
+"""
+import json
+import os
+import sqlite3
+import tempfile
+
+from config import RUN_OUTPUT_DIR
+from database import save_run, get_run
+from tracing import traced
+
+# Lines that mark a failure in the default Ansible callback output
+FAILURE_PREFIXES = ("failed:", "fatal:", "ERROR!", "Timed out after")
+
+# Default chunk size for the viewer
+CHUNK_BYTES = 64 * 1024
+
+
+def run_output_path(run_id):
+    return os.path.join(RUN_OUTPUT_DIR, f"{run_id}.log")
+
+
+def build_failure_index(data):
+    """
+    Scan encoded output once and return (line_count, failures), where each
+    failure is {"line", "offset", "task", "text"}.
+    """
+    failures = []
+    task = None
+    offset = 0
+    line_count = 0
+
+    for line_count, raw in enumerate(data.splitlines(keepends=True), start=1):
+        line = raw.decode("utf-8", errors="replace").strip()
+        if line.startswith("TASK ["):
+            task = line[len("TASK ["):].split("]", 1)[0]
+        elif line.startswith(FAILURE_PREFIXES):
+            failures.append({
+                "line": line_count,
+                "offset": offset,
+                "task": task,
+                "text": line[:200],
+            })
+        offset += len(raw)
+
+    return line_count, failures
+
+
+@traced("store_run_output")
+def store_run_output(machine_id, playbook, result_text):
+    """
+    Write a run's output to disk and record it. Returns the run id, or
+    None if the output could not be written or recorded; callers then keep
+    the output inline so nothing about the run is lost.
+    """
+    data = (result_text or "").encode("utf-8")
+    line_count, failures = build_failure_index(data)
+
+    # Write to a temp file first so a runs row never points at a missing file
+    try:
+        os.makedirs(RUN_OUTPUT_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=RUN_OUTPUT_DIR, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+    except OSError as e:
+        print(f"[RUNS] Could not store run output: {e}")
+        return None
+
+    try:
+        run_id = save_run(machine_id, playbook, len(data), line_count, json.dumps(failures))
+        os.replace(tmp_path, run_output_path(run_id))
+    except (OSError, sqlite3.Error) as e:
+        print(f"[RUNS] Could not record run output: {e}")
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        return None
+
+    return run_id
+
+
+def load_run(run_id):
+    """Return run metadata as a dict, or None if unknown."""
+    if run_id is None:
+        return None
+    row = get_run(run_id)
+    if not row:
+        return None
+
+    id, machine_id, timestamp, playbook, size, line_count, failures_json = row
+    try:
+        failures = json.loads(failures_json or "[]")
+    except json.JSONDecodeError:
+        failures = []
+
+    return {
+        "id": id,
+        "machine_id": machine_id,
+        "timestamp": timestamp,
+        "playbook": playbook,
+        "size": size,
+        "line_count": line_count,
+        "failures": failures,
+    }
@@ -0,0 +1,203 @@
+"""
+Opt-in request tracing and profiling.
+
+With TRACE_ENABLED set, every request collects timed spans (database calls,
+scan parsing, ansible runs, template rendering). Requests slower than
+TRACE_SLOW_MS are appended to TRACE_SLOW_LOG as one JSON line each.
+Streamed responses are timed until the body has been fully sent. At most
+TRACE_MAX_SPANS spans are kept per request (and none from a streamed body);
+the rest are rolled up into a count and total time per span name.
+
+With TRACE_PROFILE_ENABLED set, adding ?_profile=1 to a URL runs that single
+request under cProfile and dumps the stats into TRACE_PROFILE_DIR.
+"""
+import cProfile
+import datetime
+import functools
+import io
+import json
+import os
+import pstats
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request, before_render_template, template_rendered
+
+from config import (
+    TRACE_ENABLED,
+    TRACE_SLOW_MS,
+    TRACE_SLOW_LOG,
+    TRACE_MAX_SPANS,
+    TRACE_PROFILE_ENABLED,
+    TRACE_PROFILE_DIR,
+)
+
+
+def _active():
+    return TRACE_ENABLED and has_request_context() and "trace_spans" in g
+
+
+@contextmanager
+def span(name):
+    """Record a timed span for the current request (no-op when tracing is off)."""
+    if not _active():
+        yield
+        return
+
+    depth = g.trace_depth
+    g.trace_depth = depth + 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        g.trace_depth = depth
+        _record(name, start, end, depth)
+
+
+def _record(name, start, end, depth):
+    """
+    Keep the span itself while under TRACE_MAX_SPANS and the response has
+    not started streaming; after that only a per-name count and total are
+    kept, so memory stays bounded however long the request runs.
+    """
+    duration_ms = (end - start) * 1000
+    if len(g.trace_spans) < TRACE_MAX_SPANS and not g.trace_streaming:
+        g.trace_spans.append({
+            "name": name,
+            "start_ms": round((start - g.trace_start) * 1000, 2),
+            "duration_ms": round(duration_ms, 2),
+            "depth": depth,
+        })
+        return
+
+    rolled = g.trace_rollup.setdefault(name, {"count": 0, "total_ms": 0.0})
+    rolled["count"] += 1
+    rolled["total_ms"] += duration_ms
+
+
+def traced(name):
+    """Decorator form of span()."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _active():
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# ---------------------------------------------------------
+# Flask wiring
+# ---------------------------------------------------------
+
+def init_tracing(app):
+    if not (TRACE_ENABLED or TRACE_PROFILE_ENABLED):
+        return
+
+    @app.before_request
+    def _trace_start():
+        g.trace_start = time.perf_counter()
+        g.trace_spans = []
+        g.trace_rollup = {}
+        g.trace_streaming = False
+        g.trace_depth = 0
+        g.trace_templates = []
+
+        if TRACE_PROFILE_ENABLED and request.args.get("_profile") == "1":
+            g.trace_profiler = cProfile.Profile()
+            g.trace_profiler.enable()
+
+    @app.after_request
+    def _trace_finish(response):
+        if "trace_start" not in g:
+            return response
+
+        total_ms = (time.perf_counter() - g.trace_start) * 1000
+
+        profiler = g.pop("trace_profiler", None)
+        if profiler is not None:
+            profiler.disable()
+            _dump_profile(profiler)
+
+        if TRACE_ENABLED:
+            response.headers["Server-Timing"] = f"total;dur={total_ms:.1f}"
+            info = {
+                "method": request.method,
+                "path": request.full_path.rstrip("?"),
+                "status": response.status_code,
+                "spans": g.trace_spans,
+                "rollup": g.trace_rollup,
+            }
+
+            if response.is_streamed:
+                # Streamed bodies (exports) are generated after this hook
+                # returns, so time them when the server closes the response.
+                # Spans from the body only go into the rollup.
+                g.trace_streaming = True
+                start = g.trace_start
+
+                def _finish_streamed():
+                    streamed_ms = (time.perf_counter() - start) * 1000
+                    if streamed_ms >= TRACE_SLOW_MS:
+                        _write_slow_log(info, streamed_ms)
+
+                response.call_on_close(_finish_streamed)
+            elif total_ms >= TRACE_SLOW_MS:
+                _write_slow_log(info, total_ms)
+
+        return response
+
+    def _template_start(sender, template, context, **extra):
+        if _active():
+            g.trace_templates.append(time.perf_counter())
+
+    def _template_done(sender, template, context, **extra):
+        if _active() and g.trace_templates:
+            start = g.trace_templates.pop()
+            _record(f"render {template.name}", start, time.perf_counter(), g.trace_depth)
+
+    before_render_template.connect(_template_start, app, weak=False)
+    template_rendered.connect(_template_done, app, weak=False)
+
+
+def _write_slow_log(info, total_ms):
+    record = {
+        "timestamp": datetime.datetime.utcnow().isoformat(),
+        "method": info["method"],
+        "path": info["path"],
+        "status": info["status"],
+        "total_ms": round(total_ms, 2),
+        "spans": sorted(info["spans"], key=lambda s: s["start_ms"]),
+        "rollup": {
+            name: {"count": r["count"], "total_ms": round(r["total_ms"], 2)}
+            for name, r in info["rollup"].items()
+        },
+    }
+    print(f"[TRACE] Slow request {info['method']} {info['path']}: {total_ms:.1f} ms")
+    try:
+        with open(TRACE_SLOW_LOG, "a") as f:
+            f.write(json.dumps(record) + "\n")
+    except OSError as e:
+        print(f"[TRACE] Could not write slow log: {e}")
+
+
+def _dump_profile(profiler):
+    ts = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S%f")
+    base = os.path.join(TRACE_PROFILE_DIR, f"{ts}-{request.endpoint or 'unknown'}")
+
+    try:
+        os.makedirs(TRACE_PROFILE_DIR, exist_ok=True)
+        profiler.dump_stats(base + ".prof")
+
+        text = io.StringIO()
+        pstats.Stats(profiler, stream=text).sort_stats("cumulative").print_stats(40)
+        with open(base + ".txt", "w") as f:
+            f.write(text.getvalue())
+    except OSError as e:
+        print(f"[TRACE] Could not write profile: {e}")
+        return
+
+    print(f"[TRACE] Profile written to {base}.prof")